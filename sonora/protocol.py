@@ -7,7 +7,8 @@ import grpc
 
 
 _HEADER_FORMAT = ">BI"
-_HEADER_LENGTH = struct.calcsize(_HEADER_FORMAT)
+_HEADER = struct.Struct(_HEADER_FORMAT)
+_HEADER_LENGTH = _HEADER.size
 
 
 def _pack_header_flags(trailers, compressed):
@@ -21,13 +22,20 @@ def _unpack_header_flags(flags):
     return bool(trailers & flags), bool(compressed & flags)
 
 
+MESSAGE_FLAGS = _pack_header_flags(False, False)
+TRAILERS_FLAGS = _pack_header_flags(True, False)
+
+
+def frame_message(flags, message):
+    return _HEADER.pack(flags, len(message)) + message
+
+
+def b64_frame_message(flags, message):
+    return base64.b64encode(frame_message(flags, message))
+
+
 def wrap_message(trailers, compressed, message):
-    return (
-        struct.pack(
-            _HEADER_FORMAT, _pack_header_flags(trailers, compressed), len(message)
-        )
-        + message
-    )
+    return frame_message(_pack_header_flags(trailers, compressed), message)
 
 
 def b64_wrap_message(trailers, compressed, message):
@@ -35,7 +43,7 @@ def b64_wrap_message(trailers, compressed, message):
 
 
 def unwrap_message(message):
-    flags, length = struct.unpack(_HEADER_FORMAT, message[:_HEADER_LENGTH])
+    flags, length = _HEADER.unpack_from(message)
     data = message[_HEADER_LENGTH : _HEADER_LENGTH + length]
 
     if length != len(data):
@@ -50,11 +58,27 @@ def b64_unwrap_message(message):
     return unwrap_message(base64.b64decode(message))
 
 
+def read_message(stream, max_frame_length=None):
+    flags, length = _HEADER.unpack(stream.read(_HEADER_LENGTH))
+
+    if max_frame_length is not None and _HEADER_LENGTH + length > max_frame_length:
+        raise ValueError()
+
+    data = stream.read(length)
+
+    if length != len(data):
+        raise ValueError()
+
+    trailers, compressed = _unpack_header_flags(flags)
+
+    return trailers, compressed, data
+
+
 def unwrap_message_stream(stream):
     data = stream.read(_HEADER_LENGTH)
 
     while data:
-        flags, length = struct.unpack(_HEADER_FORMAT, data)
+        flags, length = _HEADER.unpack(data)
         trailers, compressed = _unpack_header_flags(flags)
 
         yield trailers, compressed, stream.read(length)
@@ -69,7 +93,7 @@ async def unwrap_message_stream_async(stream):
     data = await stream.readexactly(_HEADER_LENGTH)
 
     while data:
-        flags, length = struct.unpack(_HEADER_FORMAT, data)
+        flags, length = _HEADER.unpack(data)
         trailers, compressed = _unpack_header_flags(flags)
 
         yield trailers, compressed, await stream.readexactly(length)
@@ -99,7 +123,7 @@ async def unwrap_message_asgi(receive, decoder=None):
 
         if len(buffer) >= _HEADER_LENGTH:
             if not waiting:
-                flags, length = struct.unpack(_HEADER_FORMAT, buffer[:_HEADER_LENGTH])
+                flags, length = _HEADER.unpack_from(buffer)
 
             if len(buffer) >= _HEADER_LENGTH + length:
                 waiting = False
@@ -1,6 +1,7 @@
-import base64
-from collections import namedtuple
+from binascii import a2b_base64
+import string
 import time
+from typing import Callable, Dict, Optional, Tuple
 from urllib.parse import quote
 
 import grpc
@@ -8,9 +9,61 @@ import grpc
 from sonora import protocol
 
 
-_HandlerCallDetails = namedtuple(
-    "_HandlerCallDetails", ("method", "invocation_metadata")
+class _HandlerCallDetails:
+    __slots__ = ("method", "invocation_metadata")
+
+    def __init__(self, method, invocation_metadata=None):
+        self.method = method
+        self.invocation_metadata = invocation_metadata
+
+
+# Maps WSGI environ keys (HTTP_X_FOO_BIN) to their gRPC metadata names
+# (x-foo-bin) and whether the value is base64 encoded binary, or None for keys
+# that aren't HTTP headers. The set of keys a server sees is usually small, but
+# header names are client controlled so the cache is bounded.
+_HEADER_NAME_CACHE = {}  # type: Dict[str, Optional[Tuple[str, bool]]]
+_HEADER_NAME_CACHE_SIZE = 256
+
+# Upper bound on the number of request paths grpcWSGI remembers handlers (or
+# the lack of one) for. Paths that fall through to the wrapped application are
+# cached too, so this stops arbitrary URLs growing the cache forever.
+_HANDLER_CACHE_SIZE = 1024
+
+# Maps Accept header values to the response Content-Type header and the
+# function used to frame messages for it.
+_RESPONSE_FORMAT_CACHE = {}  # type: Dict[str, Tuple[Tuple[str, str], Callable]]
+_RESPONSE_FORMAT_CACHE_SIZE = 64
+
+_EXPOSE_HEADERS_HEADER = ("Access-Control-Expose-Headers", "*")
+
+_PREFLIGHT_HEADERS = (
+    ("Content-Type", "text/plain"),
+    ("Content-Length", "0"),
 )
+_CORS_PREFLIGHT_HEADERS = _PREFLIGHT_HEADERS + (
+    ("Access-Control-Allow-Methods", "POST, OPTIONS"),
+    ("Access-Control-Allow-Headers", "*"),
+    ("Access-Control-Allow-Credentials", "true"),
+    _EXPOSE_HEADERS_HEADER,
+)
+
+_EMPTY_BODY = ()
+
+# Characters urllib.parse.quote leaves alone with its default safe="/".
+_UNQUOTED_CHARS = string.ascii_letters + string.digits + "_.-~/"
+
+_GRPC_STATUS_LINES = {
+    code: f"grpc-status: {code.value[0]}\r\n" for code in grpc.StatusCode
+}
+
+# Complete trailer blocks for responses with no details or trailing metadata.
+_GRPC_STATUS_TRAILERS = {
+    code: line.encode("ascii") for code, line in _GRPC_STATUS_LINES.items()
+}
+
+# Unary responses up to this size are sent as a single body chunk with their
+# trailers. Larger ones are sent as-is to avoid copying the whole message.
+_COMBINED_RESPONSE_LIMIT = 64 * 1024
 
 
 class grpcWSGI(grpc.Server):
@@ -24,10 +77,12 @@ class grpcWSGI(grpc.Server):
     def __init__(self, application=None, enable_cors=True):
         self._application = application
         self._handlers = []
+        self._handler_cache = {}
         self._enable_cors = enable_cors
 
     def add_generic_rpc_handlers(self, handlers):
         self._handlers.extend(handlers)
+        self._handler_cache.clear()
 
     def add_insecure_port(self, port):
         raise NotImplementedError()
@@ -44,15 +99,25 @@ class grpcWSGI(grpc.Server):
     def _get_rpc_handler(self, environ):
         path = environ["PATH_INFO"]
 
-        handler_call_details = _HandlerCallDetails(path, None)
+        try:
+            return self._handler_cache[path]
+        except KeyError:
+            pass
+
+        handler_call_details = _HandlerCallDetails(path)
 
         rpc_handler = None
         for handler in self._handlers:
             rpc_handler = handler.service(handler_call_details)
             if rpc_handler:
-                return rpc_handler
+                break
+        else:
+            rpc_handler = None
 
-        return None
+        if len(self._handler_cache) < _HANDLER_CACHE_SIZE:
+            self._handler_cache[path] = rpc_handler
+
+        return rpc_handler
 
     def _create_context(self, environ):
         try:
@@ -62,26 +127,28 @@ class grpcWSGI(grpc.Server):
 
         metadata = []
         for key, value in environ.items():
-            if key.startswith("HTTP_"):
-                header = key[5:].lower().replace("_", "-")
+            try:
+                name = _HEADER_NAME_CACHE[key]
+            except KeyError:
+                name = _header_name(key)
+
+            if name is None:
+                continue
+
+            header, binary = name
 
-                if header.endswith("-bin"):
-                    value = base64.b64decode(value)
+            if binary:
+                value = a2b_base64(value)
 
-                metadata.append((header, value))
+            metadata.append((header, value))
 
         return ServicerContext(timeout, metadata)
 
     def _do_grpc_request(self, rpc_method, environ, start_response):
-        request_data = self._read_request(environ)
+        message = self._read_message(environ)
 
         context = self._create_context(environ)
 
-        if environ["CONTENT_TYPE"] == "application/grpc-web-text":
-            _, _, message = protocol.b64_unwrap_message(request_data)
-        else:
-            _, _, message = protocol.unwrap_message(request_data)
-
         request_proto = rpc_method.request_deserializer(message)
 
         resp = None
@@ -100,15 +167,13 @@ class grpcWSGI(grpc.Server):
         except NotImplementedError:
             context.set_code(grpc.StatusCode.UNIMPLEMENTED)
 
-        response_content_type = (
-            environ.get("HTTP_ACCEPT", "application/grpc-web+proto")
-            .split(",")[0]
-            .strip()
-        )
+        accept = environ.get("HTTP_ACCEPT", "application/grpc-web+proto")
+        try:
+            content_type_header, frame_message = _RESPONSE_FORMAT_CACHE[accept]
+        except KeyError:
+            content_type_header, frame_message = _response_format(accept)
 
-        headers = [
-            ("Content-Type", response_content_type),
-        ]
+        headers = [content_type_header]
         if self._enable_cors:
             headers.append(
                 (
@@ -116,67 +181,43 @@ class grpcWSGI(grpc.Server):
                     environ.get("HTTP_HOST") or environ["SERVER_NAME"],
                 ),
             )
-            headers.append(("Access-Control-Expose-Headers", "*"))
-
-        if response_content_type == "application/grpc-web-text":
-            wrap_message = protocol.b64_wrap_message
-        else:
-            wrap_message = protocol.wrap_message
+            headers.append(_EXPOSE_HEADERS_HEADER)
 
         if rpc_method.response_streaming:
-            yield from self._do_streaming_response(
-                rpc_method, start_response, wrap_message, context, headers, resp
+            return self._do_streaming_response(
+                rpc_method, start_response, frame_message, context, headers, resp
             )
 
         else:
-            yield from self._do_unary_response(
-                rpc_method, start_response, wrap_message, context, headers, resp
+            return self._do_unary_response(
+                rpc_method, start_response, frame_message, context, headers, resp
             )
 
     def _do_streaming_response(
-        self, rpc_method, start_response, wrap_message, context, headers, resp
+        self, rpc_method, start_response, frame_message, context, headers, resp
     ):
-        try:
-            first_message = next(resp)
-        except (grpc.RpcError, StopIteration):
-            first_message = None
+        frames = _stream_frames(rpc_method, frame_message, context, resp)
+
+        # Produce the first frame before starting the response so any initial
+        # metadata the servicer sends with its first message makes it into the
+        # headers. There's always at least the trailers frame.
+        first_frame = next(frames)
 
         if context._initial_metadata:
             headers.extend(context._initial_metadata)
 
         start_response("200 OK", headers)
 
-        if first_message is not None:
-            yield wrap_message(
-                False, False, rpc_method.response_serializer(first_message)
-            )
-
-        try:
-            for message in resp:
-                yield wrap_message(
-                    False, False, rpc_method.response_serializer(message)
-                )
-        except grpc.RpcError:
-            pass
-
-        trailers = [("grpc-status", str(context.code.value[0]))]
+        yield first_frame
 
-        if context.details:
-            trailers.append(("grpc-message", quote(context.details.encode("utf8"))))
-
-        if context._trailing_metadata:
-            trailers.extend(context._trailing_metadata)
-
-        trailer_message = protocol.pack_trailers(trailers)
-
-        yield wrap_message(True, False, trailer_message)
+        yield from frames
 
     def _do_unary_response(
-        self, rpc_method, start_response, wrap_message, context, headers, resp
+        self, rpc_method, start_response, frame_message, context, headers, resp
     ):
         if resp:
-            message_data = wrap_message(
-                False, False, rpc_method.response_serializer(resp)
+            message_data = frame_message(
+                protocol.MESSAGE_FLAGS, rpc_method.response_serializer(resp)
             )
         else:
             message_data = b""
@@ -184,16 +225,8 @@ class grpcWSGI(grpc.Server):
         if context._initial_metadata:
             headers.extend(context._initial_metadata)
 
-        trailers = [("grpc-status", str(context.code.value[0]))]
-
-        if context.details:
-            trailers.append(("grpc-message", quote(context.details.encode("utf8"))))
-
-        if context._trailing_metadata:
-            trailers.extend(context._trailing_metadata)
-
-        trailer_message = protocol.pack_trailers(trailers)
-        trailer_data = wrap_message(True, False, trailer_message)
+        trailer_message = _pack_trailers(context)
+        trailer_data = frame_message(protocol.TRAILERS_FLAGS, trailer_message)
 
         content_length = len(message_data) + len(trailer_data)
 
@@ -201,28 +234,26 @@ class grpcWSGI(grpc.Server):
 
         start_response("200 OK", headers)
 
-        yield message_data
-
-        yield trailer_data
+        if len(message_data) > _COMBINED_RESPONSE_LIMIT:
+            return [message_data, trailer_data]
+        else:
+            return [message_data + trailer_data]
 
     def _do_cors_preflight(self, environ, start_response):
-        headers = [
-            ("Content-Type", "text/plain"),
-            ("Content-Length", "0"),
-        ]
+        # WSGI requires a list and servers or middleware may modify it, so
+        # the shared header tuples are always copied.
         if self._enable_cors:
-            headers += [
-                ("Access-Control-Allow-Methods", "POST, OPTIONS"),
-                ("Access-Control-Allow-Headers", "*"),
+            headers = list(_CORS_PREFLIGHT_HEADERS)
+            headers.append(
                 (
                     "Access-Control-Allow-Origin",
                     environ.get("HTTP_HOST") or environ["SERVER_NAME"],
-                ),
-                ("Access-Control-Allow-Credentials", "true"),
-                ("Access-Control-Expose-Headers", "*"),
-            ]
+                )
+            )
+        else:
+            headers = list(_PREFLIGHT_HEADERS)
         start_response("204 No Content", headers)
-        return []
+        return _EMPTY_BODY
 
     def __call__(self, environ, start_response):
         """
@@ -241,15 +272,15 @@ class grpcWSGI(grpc.Server):
                 return self._do_cors_preflight(environ, start_response)
             else:
                 start_response("400 Bad Request", [])
-                return []
+                return _EMPTY_BODY
 
         if self._application:
             return self._application(environ, start_response)
         else:
             start_response("404 Not Found", [])
-            return []
+            return _EMPTY_BODY
 
-    def _read_request(self, environ):
+    def _read_message(self, environ):
         try:
             content_length = environ.get("CONTENT_LENGTH")
             if content_length:
@@ -259,21 +290,33 @@ class grpcWSGI(grpc.Server):
         except ValueError:
             content_length = None
 
-        stream = environ["wsgi.input"]
+        chunked = environ.get("HTTP_TRANSFER_ENCODING") == "chunked"
+
+        if environ["CONTENT_TYPE"] == "application/grpc-web-text":
+            request_data = self._read_request(environ, content_length, chunked)
+            _, _, message = protocol.b64_unwrap_message(request_data)
+        elif chunked or content_length is None:
+            request_data = self._read_request(environ, content_length, chunked)
+            _, _, message = protocol.unwrap_message(request_data)
+        else:
+            # Read the frame header and then the message straight from the
+            # stream, rather than reading the whole body and slicing a copy of
+            # the message out of it.
+            _, _, message = protocol.read_message(environ["wsgi.input"], content_length)
+
+        return message
 
-        transfer_encoding = environ.get("HTTP_TRANSFER_ENCODING")
+    def _read_request(self, environ, content_length, chunked):
+        stream = environ["wsgi.input"]
 
-        if transfer_encoding == "chunked":
+        if chunked:
             buffer = []
             line = stream.readline()
 
             while line:
-                if not line:
-                    break
+                size = line.split(b";", 1)[0].strip()
 
-                size = line.split(b";", 1)[0]
-
-                if size == "\r\n":
+                if not size:
                     break
 
                 chunk_size = int(size, 16)
@@ -281,14 +324,56 @@ class grpcWSGI(grpc.Server):
                 if chunk_size == 0:
                     break
 
-                buffer.append(stream.read(chunk_size + 2)[:-2])
+                buffer.append(_read_exactly(stream, chunk_size))
+
+                # Consume the CRLF that terminates each chunk.
+                stream.read(2)
+
                 line = stream.readline()
             return b"".join(buffer)
+        elif content_length is None:
+            return stream.read()
         else:
-            return stream.read(content_length or 5)
+            return stream.read(content_length)
+
+
+def _read_exactly(stream, size):
+    """
+    Read ``size`` bytes from ``stream`` into a single preallocated buffer,
+    falling back to ``read()`` for streams without ``readinto``.
+    """
+    try:
+        readinto = stream.readinto
+    except AttributeError:
+        return stream.read(size)
+
+    buffer = bytearray(size)
+    received = 0
+
+    with memoryview(buffer) as view:
+        while received < size:
+            count = readinto(view[received:])
+            if not count:
+                break
+            received += count
+
+    if received < size:
+        del buffer[received:]
+
+    return buffer
 
 
 class ServicerContext(grpc.ServicerContext):
+    __slots__ = (
+        "code",
+        "details",
+        "_timeout",
+        "_deadline",
+        "_invocation_metadata",
+        "_initial_metadata",
+        "_trailing_metadata",
+    )
+
     def __init__(self, timeout=None, metadata=None):
         self.code = grpc.StatusCode.OK
         self.details = None
@@ -377,11 +462,89 @@ class ServicerContext(grpc.ServicerContext):
         raise NotImplementedError()
 
 
+def _header_name(key):
+    if key.startswith("HTTP_"):
+        header = key[5:].lower().replace("_", "-")
+        result = (header, header.endswith("-bin"))
+    else:
+        result = None
+
+    if len(_HEADER_NAME_CACHE) < _HEADER_NAME_CACHE_SIZE:
+        _HEADER_NAME_CACHE[key] = result
+
+    return result
+
+
+def _response_format(accept):
+    content_type = accept.split(",")[0].strip()
+
+    if content_type == "application/grpc-web-text":
+        frame_message = protocol.b64_frame_message
+    else:
+        frame_message = protocol.frame_message
+
+    result = (("Content-Type", content_type), frame_message)
+
+    if len(_RESPONSE_FORMAT_CACHE) < _RESPONSE_FORMAT_CACHE_SIZE:
+        _RESPONSE_FORMAT_CACHE[accept] = result
+
+    return result
+
+
+def _pack_trailers(context):
+    """
+    Equivalent to protocol.pack_trailers for the context's status, details and
+    trailing metadata, but formats every line into one string and encodes it
+    once.
+    """
+    details = context.details
+
+    if not details and not context._trailing_metadata:
+        return _GRPC_STATUS_TRAILERS[context.code]
+
+    lines = [_GRPC_STATUS_LINES[context.code]]
+
+    if details:
+        # Single token details such as "NOT_FOUND" or "users/123" come back
+        # from quote() unchanged, so skip it for them. Anything with a space
+        # or other reserved character still needs quoting.
+        if details.rstrip(_UNQUOTED_CHARS):
+            details = quote(details.encode("utf8"))
+        lines.append(f"grpc-message: {details}\r\n")
+
+    if context._trailing_metadata:
+        for key, value in context._trailing_metadata:
+            lines.append(f"{key.lower()}: {value}\r\n")
+
+    return "".join(lines).encode("ascii")
+
+
+def _stream_frames(rpc_method, frame_message, context, resp):
+    """
+    Generate the framed messages and trailers for a streaming response,
+    independently of how they're sent.
+    """
+    if resp is not None:
+        serializer = rpc_method.response_serializer
+        flags = protocol.MESSAGE_FLAGS
+
+        try:
+            for message in resp:
+                yield frame_message(flags, serializer(message))
+        except grpc.RpcError:
+            pass
+
+    yield frame_message(protocol.TRAILERS_FLAGS, _pack_trailers(context))
+
+
 def _timeout_generator(context, gen):
-    while 1:
-        if context.time_remaining() > 0:
-            yield next(gen)
-        else:
+    deadline = context._deadline
+    monotonic = time.monotonic
+
+    for message in gen:
+        if monotonic() >= deadline:
             context.code = grpc.StatusCode.DEADLINE_EXCEEDED
             context.details = "request timed out at the server"
             raise grpc.RpcError()
+
+        yield message
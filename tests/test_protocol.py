@@ -12,6 +12,16 @@ def test_wrapping():
     assert protocol.unwrap_message(wrapped) == (False, False, data)
 
 
+def test_framing():
+    data = b"foobar"
+    assert protocol.frame_message(
+        protocol.MESSAGE_FLAGS, data
+    ) == protocol.wrap_message(False, False, data)
+    assert protocol.unwrap_message(
+        protocol.frame_message(protocol.TRAILERS_FLAGS, data)
+    ) == (True, False, data)
+
+
 def test_unwrapping_stream():
     buffer = io.BytesIO()
 
@@ -33,6 +43,24 @@ def test_unwrapping_stream():
     assert resp_messages == messages
 
 
+def test_read_message():
+    data = b"foobar"
+    wrapped = protocol.wrap_message(False, False, data)
+
+    assert protocol.read_message(io.BytesIO(wrapped)) == (False, False, data)
+    assert protocol.read_message(io.BytesIO(wrapped), len(wrapped)) == (
+        False,
+        False,
+        data,
+    )
+
+    with pytest.raises(ValueError):
+        protocol.read_message(io.BytesIO(wrapped), len(wrapped) - 1)
+
+    with pytest.raises(ValueError):
+        protocol.read_message(io.BytesIO(wrapped[:-1]))
+
+
 @pytest.mark.asyncio
 async def test_unwrapping_asgi():
     messages = [
@@ -0,0 +1,114 @@
+import io
+import time
+from urllib.parse import quote
+
+import grpc
+import pytest
+
+from sonora import protocol
+import sonora.wsgi
+from tests import benchmark_pb2, benchmark_pb2_grpc
+
+
+class _ReadOnlyStream:
+    """A wsgi.input without readinto, which PEP 3333 doesn't require."""
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def readline(self):
+        return self._stream.readline()
+
+
+_CHUNKED_BODY = b"3;ext=1\r\nfoo\r\n6\r\nbarbaz\r\n0\r\n\r\n"
+
+
+def test_read_request_chunked():
+    environ = {"wsgi.input": io.BytesIO(_CHUNKED_BODY)}
+    app = sonora.wsgi.grpcWSGI()
+
+    assert app._read_request(environ, None, True) == b"foobarbaz"
+
+
+def test_read_request_chunked_without_readinto():
+    environ = {"wsgi.input": _ReadOnlyStream(_CHUNKED_BODY)}
+    app = sonora.wsgi.grpcWSGI()
+
+    assert app._read_request(environ, None, True) == b"foobarbaz"
+
+
+def test_read_message_without_content_length():
+    message = b"x" * 100
+    environ = {
+        "CONTENT_TYPE": "application/grpc-web+proto",
+        "wsgi.input": io.BytesIO(protocol.wrap_message(False, False, message)),
+    }
+    app = sonora.wsgi.grpcWSGI()
+
+    assert app._read_message(environ) == message
+
+
+def test_timeout_generator_finite_stream():
+    context = sonora.wsgi.ServicerContext(10)
+
+    assert list(sonora.wsgi._timeout_generator(context, iter(range(3)))) == [0, 1, 2]
+    assert context.code == grpc.StatusCode.OK
+
+
+def test_timeout_generator_deadline_exceeded():
+    context = sonora.wsgi.ServicerContext(0.01)
+
+    def messages():
+        while True:
+            time.sleep(0.02)
+            yield None
+
+    with pytest.raises(grpc.RpcError):
+        for _ in sonora.wsgi._timeout_generator(context, messages()):
+            pass
+
+    assert context.code == grpc.StatusCode.DEADLINE_EXCEEDED
+
+
+@pytest.mark.parametrize("details", ["NOT_FOUND", "test aborting", "caf\u00e9 50%"])
+def test_pack_trailers_details(details):
+    context = sonora.wsgi.ServicerContext()
+    context.set_code(grpc.StatusCode.NOT_FOUND)
+    context.set_details(details)
+
+    assert sonora.wsgi._pack_trailers(context) == protocol.pack_trailers(
+        [
+            ("grpc-status", str(grpc.StatusCode.NOT_FOUND.value[0])),
+            ("grpc-message", quote(details.encode("utf8"))),
+        ]
+    )
+
+
+def test_unimplemented_streaming_method():
+    app = sonora.wsgi.grpcWSGI()
+    benchmark_pb2_grpc.add_BenchmarkServiceServicer_to_server(
+        benchmark_pb2_grpc.BenchmarkServiceServicer(), app
+    )
+
+    body = protocol.wrap_message(
+        False, False, benchmark_pb2.SimpleRequest().SerializeToString()
+    )
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": "/benchmark.BenchmarkService/StreamingBothWays",
+        "CONTENT_TYPE": "application/grpc-web+proto",
+        "CONTENT_LENGTH": str(len(body)),
+        "SERVER_NAME": "localhost",
+        "wsgi.input": io.BytesIO(body),
+    }
+
+    statuses = []
+    response = b"".join(app(environ, lambda status, headers: statuses.append(status)))
+
+    assert statuses == ["200 OK"]
+    assert list(protocol.unwrap_message_stream(io.BytesIO(response))) == [
+        (True, False, b"grpc-status: 12\r\n")
+    ]